@@ -1,8 +1,10 @@
 import asyncio
 import copy
 import errno
-import ipaddress
+import functools
 import os
+import socket
+import stat
 
 from middlewared.service_exception import ValidationErrors
 from middlewared.validators import ShouldBe
@@ -19,27 +21,73 @@ class Error(Exception):
         return '[{0}] {1}'.format(self.attribute, self.errmsg)
 
 
+def cache_json_schema(f):
+    """
+    Cache the top level (no `parent`) json schema of an attribute until
+    `_compile` is called for it again. A shallow copy is returned every time.
+    """
+    @functools.wraps(f)
+    def to_json_schema(self, parent=None):
+        if parent:
+            return f(self, parent)
+        if self._json_cache is None:
+            self._json_cache = f(self)
+        return copy.copy(self._json_cache)
+    return to_json_schema
+
+
+@functools.lru_cache(maxsize=None)
+def _slot_names(klass):
+    return tuple(name for k in klass.__mro__ for name in k.__dict__.get('__slots__', ()))
+
+
 class EnumMixin(object):
 
+    # `enum` slots are declared by each concrete class to avoid a layout conflict
+    # with Attribute
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         self.enum = kwargs.pop('enum', None)
         super(EnumMixin, self).__init__(*args, **kwargs)
+        self._compile()
+
+    def _compile(self):
+        # `enum` is kept as given for to_json_schema, the set is used for lookups
+        self._enum_set = frozenset(self.enum) if self.enum is not None else None
+        super(EnumMixin, self)._compile()
+
+    def _clone_members(self):
+        # Patch edit methods may append to `enum`
+        if self.enum is not None:
+            self.enum = list(self.enum)
+        super(EnumMixin, self)._clone_members()
 
     def clean(self, value):
-        if self.enum is None:
+        enum_set = self._enum_set
+        if enum_set is None:
             return value
-        if not isinstance(value, (list, tuple)):
-            tmp = [value]
-        else:
-            tmp = value
-        for v in tmp:
-            if v not in self.enum:
-                raise Error(self.name, 'Invalid choice: {0}'.format(value))
-        return value
+        try:
+            if isinstance(value, (list, tuple)):
+                for v in value:
+                    if v not in enum_set:
+                        break
+                else:
+                    return value
+            elif value in enum_set:
+                return value
+        except TypeError:
+            # Unhashable values can never be a valid choice
+            pass
+        raise Error(self.name, 'Invalid choice: {0}'.format(value))
 
 
 class Attribute(object):
 
+    __slots__ = ('name', 'has_default', 'default', 'required', 'verbose', 'validators', 'register', '_json_cache')
+    # Values of immutable types are not copied by copy_value
+    immutable = False
+
     def __init__(self, name, verbose=None, required=False, validators=None, register=False, **kwargs):
         self.name = name
         self.has_default = 'default' in kwargs
@@ -48,10 +96,32 @@ class Attribute(object):
         self.verbose = verbose or name
         self.validators = validators or []
         self.register = register
+        self._json_cache = None
 
     def clean(self, value):
         return value
 
+    def copy_value(self, value):
+        # Copy so that clean and the method do not modify the caller's value
+        if self.immutable:
+            return value
+        return copy.deepcopy(value)
+
+    def _compile(self):
+        # Called again whenever the attribute is modified (e.g. Patch edit)
+        self._json_cache = None
+
+    def _clone(self):
+        clone = object.__new__(type(self))
+        for name in _slot_names(type(self)):
+            setattr(clone, name, getattr(self, name))
+        clone._clone_members()
+        clone._compile()
+        return clone
+
+    def _clone_members(self):
+        self.validators = list(self.validators)
+
     def validate(self, value):
         verrors = ValidationErrors()
 
@@ -92,6 +162,9 @@ class Attribute(object):
 
 class Any(Attribute):
 
+    __slots__ = ()
+
+    @cache_json_schema
     def to_json_schema(self, parent=None):
         schema = {'anyOf': [
             {'type': 'string'},
@@ -107,14 +180,19 @@ class Any(Attribute):
 
 class Str(EnumMixin, Attribute):
 
+    __slots__ = ('enum', '_enum_set')
+    immutable = True
+
     def clean(self, value):
-        value = super(Str, self).clean(value)
+        if self._enum_set is not None:
+            value = super(Str, self).clean(value)
         if value is None and not self.required:
             return self.default
         if not isinstance(value, str):
             raise Error(self.name, 'Not a string')
         return value
 
+    @cache_json_schema
     def to_json_schema(self, parent=None):
         schema = {}
         if not parent:
@@ -131,14 +209,20 @@ class Str(EnumMixin, Attribute):
 
 class Dir(Str):
 
+    __slots__ = ()
+
     def validate(self, value):
         verrors = ValidationErrors()
 
         if value:
-            if not os.path.exists(value):
+            # A single stat() answers both "exists" and "is a directory"
+            try:
+                st = os.stat(value)
+            except (OSError, ValueError):
                 verrors.add(self.name, "This path does not exist.", errno.ENOENT)
-            elif not os.path.isdir(value):
-                verrors.add(self.name, "This path is not a directory.", errno.ENOTDIR)
+            else:
+                if not stat.S_ISDIR(st.st_mode):
+                    verrors.add(self.name, "This path is not a directory.", errno.ENOTDIR)
 
         if verrors:
             raise verrors
@@ -148,14 +232,19 @@ class Dir(Str):
 
 class File(Str):
 
+    __slots__ = ()
+
     def validate(self, value):
         verrors = ValidationErrors()
 
         if value:
-            if not os.path.exists(value):
+            try:
+                st = os.stat(value)
+            except (OSError, ValueError):
                 verrors.add(self.name, "This path does not exist.", errno.ENOENT)
-            elif not os.path.isfile(value):
-                verrors.add(self.name, "This path is not a file.", errno.EISDIR)
+            else:
+                if not stat.S_ISREG(st.st_mode):
+                    verrors.add(self.name, "This path is not a file.", errno.EISDIR)
 
         if verrors:
             raise verrors
@@ -165,17 +254,27 @@ class File(Str):
 
 class IPAddr(Str):
 
+    __slots__ = ()
+
     def validate(self, value):
         if value:
+            # inet_pton only parses the address, ipaddress.ip_address would
+            # build an address object we have no use for
             try:
-                ipaddress.ip_address(value)
-            except ValueError:
-                raise Error(self.name, f'Not a valid IP Address: {value}')
+                socket.inet_pton(socket.AF_INET, value)
+            except (OSError, ValueError):
+                try:
+                    socket.inet_pton(socket.AF_INET6, value)
+                except (OSError, ValueError):
+                    raise Error(self.name, f'Not a valid IP Address: {value}')
         return super().validate(value)
 
 
 class Bool(Attribute):
 
+    __slots__ = ()
+    immutable = True
+
     def clean(self, value):
         if value is None and not self.required:
             return self.default
@@ -183,6 +282,7 @@ class Bool(Attribute):
             raise Error(self.name, 'Not a boolean')
         return value
 
+    @cache_json_schema
     def to_json_schema(self, parent=None):
         schema = {
             'type': ['boolean', 'null'] if not self.required else 'boolean',
@@ -195,15 +295,23 @@ class Bool(Attribute):
 
 class Int(Attribute):
 
+    __slots__ = ()
+    immutable = True
+
     def clean(self, value):
         if value is None and not self.required:
             return self.default
         if not isinstance(value, int):
             if isinstance(value, str) and value.isdigit():
-                return int(value)
+                # isdigit() is also true for digits int() does not accept, e.g. superscripts
+                try:
+                    return int(value)
+                except ValueError:
+                    pass
             raise Error(self.name, 'Not an integer')
         return value
 
+    @cache_json_schema
     def to_json_schema(self, parent=None):
         schema = {
             'type': ['integer', 'null'] if not self.required else 'integer',
@@ -216,6 +324,8 @@ class Int(Attribute):
 
 class List(EnumMixin, Attribute):
 
+    __slots__ = ('enum', '_enum_set', 'items')
+
     def __init__(self, *args, **kwargs):
         self.items = kwargs.pop('items', [])
         if 'default' not in kwargs:
@@ -223,24 +333,34 @@ class List(EnumMixin, Attribute):
         super(List, self).__init__(*args, **kwargs)
 
     def clean(self, value):
-        value = super(List, self).clean(value)
+        if self._enum_set is not None:
+            value = super(List, self).clean(value)
         if value is None and not self.required:
             return copy.copy(self.default)
         if not isinstance(value, list):
             raise Error(self.name, 'Not a list')
-        if self.items:
+        items = self.items
+        if items:
             for index, v in enumerate(value):
-                for i in self.items:
+                # The first item type which is able to clean the value wins
+                for i in items:
                     try:
                         value[index] = i.clean(v)
-                        found = True
-                    except Error as e:
-                        found = e
                         break
-                if self.items and found is not True:
-                    raise Error(self.name, 'Item#{0} is not valid per list types: {1}'.format(index, found))
+                    except Error as e:
+                        error = e
+                else:
+                    raise Error(self.name, 'Item#{0} is not valid per list types: {1}'.format(index, error))
         return value
 
+    def copy_value(self, value):
+        if not isinstance(value, list):
+            return value
+        if len(self.items) == 1:
+            item = self.items[0]
+            return [item.copy_value(v) for v in value]
+        return copy.deepcopy(value)
+
     def validate(self, value):
         verrors = ValidationErrors()
 
@@ -254,6 +374,7 @@ class List(EnumMixin, Attribute):
         if verrors:
             raise verrors
 
+    @cache_json_schema
     def to_json_schema(self, parent=None):
         schema = {'type': 'array'}
         if not parent:
@@ -274,9 +395,18 @@ class List(EnumMixin, Attribute):
             middleware.add_schema(self)
         return self
 
+    def _clone_members(self):
+        self.items = [i._clone() for i in self.items]
+        super(List, self)._clone_members()
+
 
 class Dict(Attribute):
 
+    __slots__ = (
+        'additional_attrs', 'update', 'attrs',
+        '_names', '_attrs', '_fast_clean', '_fast_validate',
+    )
+
     def __init__(self, name, *attrs, **kwargs):
         self.additional_attrs = kwargs.pop('additional_attrs', False)
         # Update property is used to disable requirement on all attributes
@@ -286,51 +416,108 @@ class Dict(Attribute):
         self.attrs = {}
         for i in attrs:
             self.attrs[i.name] = i
+        # Children may still be Ref/Patch at this point, in which case
+        # compiling is left to `resolve` once they have been resolved
+        if all(isinstance(attr, Attribute) for attr in self.attrs.values()):
+            self._compile()
 
-    def clean(self, data):
-        if data is None and not self.required:
-            data = {}
+    def _compile(self):
+        """
+        Flatten `attrs` into the tuples walked by `clean` and `validate` so
+        that they do not have to inspect every attribute on each call.
+        This needs to be called again whenever `attrs` is changed.
+        """
+        # Names and attributes are kept in parallel tuples, iterated together
+        self._names = tuple(self.attrs)
+        self._attrs = tuple(self.attrs.values())
+        self._fast_clean = self._build_clean()
+        self._fast_validate = self._build_validate()
+        super(Dict, self)._compile()
+
+    def _build_clean(self):
+        """
+        Build a clean function specialized for this schema. Cleaning, required
+        fields and defaults are handled in a single pass over the fields, the
+        unexpected fields check is left out when it cannot apply and everything
+        it needs is bound as a closure variable.
+        """
+        names = self._names
+        # Do not make any field and required and not populate default values
+        check = not self.update
+        schedule = tuple(
+            (name, attr.clean, check and attr.required, check and attr.has_default, attr.default)
+            for name, attr in zip(names, self._attrs)
+        )
 
-        self.errors = []
-        if not isinstance(data, dict):
-            raise Error(self.name, 'A dict was expected')
+        def clean_fields(data):
+            for name, clean, required, has_default, default in schedule:
+                if name in data:
+                    data[name] = clean(data[name])
+                elif required:
+                    raise Error(name, 'This field is required')
+                elif has_default:
+                    # Method may modify it, do not hand out the schema's own default
+                    data[name] = copy.copy(default)
 
-        for key, value in list(data.items()):
-            if not self.additional_attrs:
-                if key not in self.attrs:
-                    raise Error(key, 'Field was not expected')
+            return data
 
-            attr = self.attrs.get(key)
-            if not attr:
-                continue
+        if self.additional_attrs:
+            return clean_fields
 
-            data[key] = attr.clean(value)
+        allowed = frozenset(names)
 
-        # Do not make any field and required and not populate default values
-        if not self.update:
-            for attr in list(self.attrs.values()):
+        def clean(data):
+            # Only look for the offending key once we know there is one
+            if not allowed.issuperset(data):
+                for key in data:
+                    if key not in allowed:
+                        raise Error(key, 'Field was not expected')
+            return clean_fields(data)
 
-                if attr.required and attr.name not in data:
-                    raise Error(attr.name, 'This field is required')
+        return clean
 
-                if attr.name not in data and attr.has_default:
-                    data[attr.name] = attr.default
+    def _build_validate(self):
+        names = self._names
+        validators = tuple(attr.validate for attr in self._attrs)
+        name = self.name
 
-        return data
+        def validate(value):
+            verrors = ValidationErrors()
 
-    def validate(self, value):
-        verrors = ValidationErrors()
+            for key, validate_field in zip(names, validators):
+                if key in value:
+                    try:
+                        validate_field(value[key])
+                    except ValidationErrors as e:
+                        verrors.add_child(name, e)
 
-        for attr in self.attrs.values():
-            if attr.name in value:
-                try:
-                    attr.validate(value[attr.name])
-                except ValidationErrors as e:
-                    verrors.add_child(self.name, e)
+            if verrors:
+                raise verrors
 
-        if verrors:
-            raise verrors
+        return validate
 
+    def clean(self, data):
+        if data is None and not self.required:
+            data = {}
+
+        if not isinstance(data, dict):
+            raise Error(self.name, 'A dict was expected')
+
+        return self._fast_clean(data)
+
+    def copy_value(self, value):
+        if not isinstance(value, dict):
+            return value
+        attrs = self.attrs
+        return {
+            k: attrs[k].copy_value(v) if k in attrs else copy.deepcopy(v)
+            for k, v in value.items()
+        }
+
+    def validate(self, value):
+        return self._fast_validate(value)
+
+    @cache_json_schema
     def to_json_schema(self, parent=None):
         schema = {
             'type': 'object',
@@ -340,17 +527,22 @@ class Dict(Attribute):
         if not parent:
             schema['title'] = self.verbose
             schema['_required_'] = self.required
-        for name, attr in list(self.attrs.items()):
+        for name, attr in self.attrs.items():
             schema['properties'][name] = attr.to_json_schema(parent=self)
         return schema
 
     def resolve(self, middleware):
-        for name, attr in list(self.attrs.items()):
+        for name, attr in self.attrs.items():
             self.attrs[name] = attr.resolve(middleware)
+        self._compile()
         if self.register:
             middleware.add_schema(self)
         return self
 
+    def _clone_members(self):
+        self.attrs = {name: attr._clone() for name, attr in self.attrs.items()}
+        super(Dict, self)._clone_members()
+
 
 class Ref(object):
 
@@ -361,7 +553,7 @@ class Ref(object):
         schema = middleware.get_schema(self.name)
         if not schema:
             raise ResolverError('Schema {0} does not exist'.format(self.name))
-        schema = copy.deepcopy(schema)
+        schema = schema._clone()
         schema.register = False
         return schema
 
@@ -392,7 +584,7 @@ class Patch(object):
         if not isinstance(schema, Dict):
             raise ValueError('Patch non-dict is not allowed')
 
-        schema = copy.deepcopy(schema)
+        schema = schema._clone()
         schema.name = self.newname
         for operation, patch in self.patches:
             if operation == 'add':
@@ -404,9 +596,11 @@ class Patch(object):
                 attr = schema.attrs[patch['name']]
                 if 'method' in patch:
                     patch['method'](attr)
+                    attr._compile()
             elif operation == 'attr':
-                for key, val in list(patch.items()):
+                for key, val in patch.items():
                     setattr(schema, key, val)
+        schema._compile()
         if self.register:
             middleware.add_schema(schema)
         return schema
@@ -441,22 +635,26 @@ def accepts(*schema):
             args_index += 1
         if hasattr(f, '_job'):
             args_index += 1
-        assert len(schema) == f.__code__.co_argcount - args_index  # -1 for self
+        # Signature is looked up once here rather than on every call
+        argcount = f.__code__.co_argcount
+        varnames = f.__code__.co_varnames
+        assert len(schema) == argcount - args_index  # -1 for self
 
         def clean_and_validate_args(args, kwargs):
+            # Arguments are copied as they are cleaned (Attribute.copy_value) so
+            # that neither clean nor the method itself change caller's objects
             args = list(args)
-            args = args[:args_index] + copy.deepcopy(args[args_index:])
-            kwargs = copy.deepcopy(kwargs)
 
             verrors = ValidationErrors()
+            params = nf.accepts
 
             # Iterate over positional args first, excluding self
             i = 0
-            for _ in args[args_index:]:
-                attr = nf.accepts[i]
+            for index in range(args_index, len(args)):
+                attr = params[i]
 
-                value = attr.clean(args[args_index + i])
-                args[args_index + i] = value
+                value = attr.clean(attr.copy_value(args[index]))
+                args[index] = value
 
                 try:
                     attr.validate(value)
@@ -466,16 +664,16 @@ def accepts(*schema):
                 i += 1
 
             # Use i counter to map keyword argument to rpc positional
-            for x in list(range(i + 1, f.__code__.co_argcount)):
-                kwarg = f.__code__.co_varnames[x]
+            for x in range(i + 1, argcount):
+                kwarg = varnames[x]
 
                 if kwarg in kwargs:
-                    attr = nf.accepts[i]
+                    attr = params[i]
                     i += 1
 
                     value = kwargs[kwarg]
-                elif len(nf.accepts) >= i + args_index:
-                    attr = nf.accepts[i]
+                elif len(params) >= i + args_index:
+                    attr = params[i]
                     i += 1
 
                     value = None
@@ -483,7 +681,7 @@ def accepts(*schema):
                     i += 1
                     continue
 
-                value = attr.clean(value)
+                value = attr.clean(attr.copy_value(value))
                 kwargs[kwarg] = value
 
                 try: